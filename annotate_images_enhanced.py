@@ -16,83 +16,204 @@ Usage
         --output path/to/file_annotated.md \
         --summary path/to/summary.md \
         --categories img-parse/image_categories.json \
+        --concurrency 4 \
         --model qwen3-vl:30b   # any Ollama vision model
 
+Images are analyzed concurrently; start Ollama with OLLAMA_NUM_PARALLEL>1 so
+the server actually runs those requests in parallel.
+
 Dependencies (install with uv)
 ---------------
-    uv add requests pillow rich
+    uv add httpx orjson pillow rich
 """
 
 import argparse
+import asyncio
 import base64
+import bisect
+import functools
+import io
 import json
 import os
 import re
+import shutil
 import sys
 import unicodedata
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Optional, Callable, Set
 
-import requests
+import orjson
 from PIL import Image
 from rich.console import Console
-from rich.progress import track
+from rich.progress import Progress
+
+from diagramlens import OllamaClient, ResponseCache, file_digest, load_image_as_base64
+
+try:
+    import re2  # optional: google-re2, linear-time matching for large documents
+except ImportError:
+    re2 = None
 
 # ---------------------------------------------------------------
 # Ollama helper
 # ---------------------------------------------------------------
-OLLAMA_URL = "http://localhost:11434/api/chat"
-MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5 MiB
+MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5 MiB; larger files are re-encoded until they fit
+MAX_IMAGE_SIDE = 1536  # px; larger images are downscaled before upload
+JPEG_QUALITY = 85
+MIN_JPEG_QUALITY = 50  # oversized JPEGs drop to this quality before being scaled down
 CONTEXT_CHARS = 500  # Characters of context to extract before/after image
+MIN_CONTEXT_SIGNAL = 40  # chars; below this, context pre-categorization is skipped
+# Generation budgets (num_predict); a category name is only a few tokens
+CATEGORY_MAX_TOKENS = 8
+DESCRIPTION_MAX_TOKENS = 800
+COMBINED_MAX_TOKENS = 1024  # description plus the JSON wrapper
+# Full description prompts embedded in a combined request (the likeliest categories)
+COMBINED_TEMPLATE_LIMIT = 3
+DEFAULT_CACHE_DB = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "diagramlens" / "ollama_responses.sqlite"
+)
+
+
+def _quick_valid_image(image_path: Path) -> bool:
+    """
+    Cheap validity check: sniff the magic bytes of the formats Ollama accepts
+    (PNG, JPEG, GIF, WebP) instead of letting PIL parse the whole file.
+    """
+    try:
+        with image_path.open("rb") as f:
+            head = f.read(12)
+    except OSError:
+        return False
+    return (
+        head.startswith(b"\x89PNG\r\n\x1a\n")
+        or head.startswith(b"\xff\xd8\xff")
+        or head.startswith((b"GIF87a", b"GIF89a"))
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+    )
+
+
+# Bump whenever _prepare_image_base64 changes the payload it produces
+PREPROCESS_VERSION = 3
+
+
+def _image_variant(max_side: int, jpeg_quality: int) -> str:
+    """Cache tag for an image prepared by _prepare_image_base64 with these settings."""
+    return f"v{PREPROCESS_VERSION}:{max_side}:{jpeg_quality}"
+
+
+def _prepare_image_base64(
+    image_path: Path,
+    max_side: int = MAX_IMAGE_SIDE,
+    jpeg_quality: int = JPEG_QUALITY,
+    file_size: Optional[int] = None,
+) -> str:
+    """
+    Return the image as base64, ready to attach to an Ollama request.
+    Images within max_side and MAX_IMAGE_SIZE are sent unchanged; anything
+    bigger is downscaled in memory, since the vision model works at its own
+    (lower) internal resolution anyway. PNG and GIF sources (screenshots and
+    line art) are re-encoded losslessly as PNG unless that is still larger
+    than MAX_IMAGE_SIZE; everything else is re-encoded as JPEG, lowering the
+    quality (down to MIN_JPEG_QUALITY) and then the resolution until the
+    result fits within MAX_IMAGE_SIZE.
+    Pass file_size when it is already known to skip a stat() call.
+    """
+    if file_size is None:
+        file_size = image_path.stat().st_size
+    with Image.open(image_path) as im:
+        if max(im.size) <= max_side and file_size <= MAX_IMAGE_SIZE:
+            return load_image_as_base64(image_path)
+
+        lossless = im.format in ("PNG", "GIF")
+        # Lanczos keeps thin lines and small labels legible when shrinking
+        im.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+            # Flatten transparency onto white so line art stays visible
+            rgba = im.convert("RGBA")
+            flat = Image.new("RGB", rgba.size, "white")
+            flat.paste(rgba, mask=rgba.getchannel("A"))
+        else:
+            flat = im.convert("RGB")
 
+    buf = io.BytesIO()
+    if lossless:
+        flat.save(buf, "PNG", optimize=True)
+        if buf.tell() <= MAX_IMAGE_SIZE:
+            return base64.b64encode(buf.getbuffer()).decode("ascii")
+        # Still too big losslessly (e.g. noisy screenshots): fall back to JPEG
 
-def _load_image_as_base64(image_path: Path) -> str:
-    """Read an image file and return a base64‑encoded string."""
-    with image_path.open("rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+    quality = jpeg_quality
+    while True:
+        buf = io.BytesIO()
+        flat.save(buf, "JPEG", quality=quality)
+        if buf.tell() <= MAX_IMAGE_SIZE or max(flat.size) <= 1:
+            return base64.b64encode(buf.getbuffer()).decode("ascii")
+        if quality > MIN_JPEG_QUALITY:
+            quality = max(MIN_JPEG_QUALITY, quality - 10)
+        else:
+            # Quality is at its floor; shrink the image instead
+            flat = flat.resize(
+                (max(1, flat.width * 3 // 4), max(1, flat.height * 3 // 4)),
+                Image.Resampling.LANCZOS,
+            )
 
 
-def call_ollama(
+async def call_ollama(
+    client: OllamaClient,
     model: str,
     prompt: str,
     image_path: Path | None = None,
     temperature: float = 0.0,
+    format: str | None = None,
+    image_digest: Optional[str] = None,
+    image_b64: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+    stop: Optional[List[str]] = None,
+    greedy: bool = False,
+    image_variant: str = "",
 ) -> str:
     """
-    Send a request to the local Ollama server with proper image handling.
+    Send a request to the local Ollama server through the shared client.
+    See OllamaClient.chat for the parameters; returns "" on failure.
     """
-    # Build message with image attached if provided
-    message = {"role": "user", "content": prompt}
-    
-    if image_path:
-        # Verify image validity
-        Image.open(image_path).verify()
-        # Attach image to the message object
-        message["images"] = [_load_image_as_base64(image_path)]
-    
-    payload = {
-        "model": model,
-        "messages": [message],
-        "options": {
-            "temperature": temperature,
-        },
-        "stream": False,
-    }
-
-    try:
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=180)
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("message", {}).get("content", "").strip()
-    except Exception as exc:
-        sys.stderr.write(f"[ERROR] Ollama request failed: {exc}\n")
-        return ""
+    return await client.chat(
+        model,
+        prompt,
+        image_path=image_path,
+        temperature=temperature,
+        format=format,
+        image_digest=image_digest,
+        image_b64=image_b64,
+        max_tokens=max_tokens,
+        stop=stop,
+        greedy=greedy,
+        image_variant=image_variant,
+    )
 
 
 # ---------------------------------------------------------------
 # Markdown processing
 # ---------------------------------------------------------------
-IMG_REGEX = re.compile(r"!\[(?P<alt>.*?)\]\((?P<path>[^)]+)\)")
+# Negated classes instead of a lazy ".*?" keep matching linear on long alt text.
+# The full-document scans use RE2 when installed; the patterns suit both engines.
+_scan_re = re2 or re
+IMG_REGEX = _scan_re.compile(r"!\[(?P<alt>[^\]]*)\]\((?P<path>[^)]+)\)")
+HEADING_RE = _scan_re.compile(r"(?m)^#+\s+(.+)$")
+# Paragraph/section breaks; the lookahead also reports overlapping "\n\n" runs
+# (RE2 has no lookahead, so these stay on the stdlib engine)
+BLANK_LINE_RE = re.compile(r"\n(?=\n)")
+HEADING_BREAK_RE = re.compile(r"\n#")
+
+
+def _find_in_window(positions: List[int], lo: int, hi: int, last: bool = False) -> int:
+    """First (or last) offset in sorted positions within [lo, hi], or -1."""
+    if last:
+        i = bisect.bisect_right(positions, hi) - 1
+        return positions[i] if i >= 0 and positions[i] >= lo else -1
+    i = bisect.bisect_left(positions, lo)
+    return positions[i] if i < len(positions) and positions[i] <= hi else -1
 
 
 def find_image_refs_with_context(md_text: str, context_size: int = CONTEXT_CHARS) -> List[Dict[str, Any]]:
@@ -100,35 +221,48 @@ def find_image_refs_with_context(md_text: str, context_size: int = CONTEXT_CHARS
     Find all markdown image references in the text with surrounding context.
     Returns: List of dictionaries containing image info and context
     """
+    # One pass over the document for headings and paragraph/section breaks;
+    # each image then looks up its neighbours by binary search.
+    headings = [(m.start(), m.start(1), m.end(1)) for m in HEADING_RE.finditer(md_text)]
+    heading_starts = [h[0] for h in headings]
+    blank_lines = [m.start() for m in BLANK_LINE_RE.finditer(md_text)]
+    heading_breaks = [m.start() for m in HEADING_BREAK_RE.finditer(md_text)]
+
     matches = []
     for m in IMG_REGEX.finditer(md_text):
         # Extract surrounding context
         start_idx = m.start()
         end_idx = m.end()
         
-        # Get context before (look for paragraph or section breaks)
+        # Get context before, from the last paragraph or section break
         context_start = max(0, start_idx - context_size)
-        text_before = md_text[context_start:start_idx]
-        
-        # Try to find the start of the paragraph/section
-        para_breaks = [text_before.rfind('\n\n'), text_before.rfind('\n#')]
-        para_start = max(para_breaks)
-        if para_start > 0:
-            text_before = text_before[para_start:].strip()
+        para_start = max(
+            _find_in_window(blank_lines, context_start, start_idx - 2, last=True),
+            _find_in_window(heading_breaks, context_start, start_idx - 2, last=True),
+        )
+        if para_start > context_start:
+            text_before = md_text[para_start:start_idx].strip()
+        else:
+            text_before = md_text[context_start:start_idx]
         
-        # Get context after
+        # Get context after, up to the next paragraph or section break
         context_end = min(len(md_text), end_idx + context_size)
-        text_after = md_text[end_idx:context_end]
-        
-        # Try to find the end of the paragraph/section
-        para_breaks = [text_after.find('\n\n'), text_after.find('\n#')]
-        para_end = min([p for p in para_breaks if p > 0], default=len(text_after))
-        text_after = text_after[:para_end].strip()
+        para_ends = [
+            _find_in_window(blank_lines, end_idx, context_end - 2),
+            _find_in_window(heading_breaks, end_idx, context_end - 2),
+        ]
+        para_end = min([p for p in para_ends if p > end_idx], default=context_end)
+        text_after = md_text[end_idx:para_end].strip()
         
-        # Extract any headings above the image
-        heading_search = md_text[max(0, start_idx - 1000):start_idx]
-        heading_match = re.findall(r'^#+\s+(.+)$', heading_search, re.MULTILINE)
-        current_heading = heading_match[-1] if heading_match else ""
+        # Nearest heading above the image (within 1000 characters)
+        current_heading = ""
+        i = bisect.bisect_left(heading_starts, start_idx) - 1
+        while not current_heading and i >= 0 and headings[i][0] >= start_idx - 1000:
+            _, text_start, text_end = headings[i]
+            # A heading on the image's own line ends where the image starts;
+            # one that is nothing but the image does not count
+            current_heading = md_text[text_start:min(text_end, start_idx)]
+            i -= 1
         
         matches.append({
             "path": m.group("path"),
@@ -143,16 +277,31 @@ def find_image_refs_with_context(md_text: str, context_size: int = CONTEXT_CHARS
     return matches
 
 
-def pre_categorize_with_context(
+def _context_signal(context_info: Dict[str, str]) -> int:
+    """Characters of usable document context around an image."""
+    return sum(
+        len(context_info[k].strip())
+        for k in ("text_before", "text_after", "current_heading", "alt_text")
+    )
+
+
+async def pre_categorize_with_context(
+    client: OllamaClient,
     context_info: Dict[str, str],
     categories: List[str],
     model: str,
-    temperature: float = 0.1
+    temperature: float = 0.1,
+    categories_lower: Optional[frozenset] = None,
 ) -> Optional[str]:
     """
     Use surrounding text context to predict the diagram type before image analysis.
-    Returns a predicted category or None if uncertain.
+    Returns a predicted category or None if uncertain, without asking the
+    model when there is too little context to go on.
+    Pass categories_lower (the lowercased category set) to avoid rebuilding it.
     """
+    if _context_signal(context_info) < MIN_CONTEXT_SIGNAL:
+        return None
+
     prompt = f"""Based on the surrounding text context, predict what type of diagram is being referenced.
 
 Current section heading: {context_info['current_heading'] or 'None'}
@@ -183,29 +332,757 @@ Look for keywords that indicate the diagram type:
 
 Reply with ONLY the most likely category name. If you cannot determine with reasonable confidence, reply with "unknown"."""
 
-    response = call_ollama(
+    response = await call_ollama(
+        client,
         model=model,
         prompt=prompt,
-        temperature=temperature
+        temperature=temperature,
+        max_tokens=CATEGORY_MAX_TOKENS,
+        stop=["\n"],
+        greedy=True,
     )
     
     # Normalize the response
     if response:
         response = response.lower().strip()
-        if response in [c.lower() for c in categories]:
+        if categories_lower is None:
+            categories_lower = frozenset(c.lower() for c in categories)
+        if response in categories_lower:
             return response
     return None
 
 
+DISTINGUISHING_FEATURES = """Key distinguishing features:
+- C4 Model: Has explicit C4 level labels (Context/Container/Component), technology tags in brackets
+- Use Case: Has actors (stick figures), ovals for use cases, system boundary rectangle
+- Class Diagram: Shows classes with attributes/methods, inheritance arrows
+- Entity Relationship: Shows entities with attributes, relationship lines with cardinality
+- Architecture: Shows system components, layers, external services
+- Sequence: Has lifelines, messages between objects, activation boxes
+- Data Flow: Has numbered processes, data stores, external entities"""
+
+
+def build_category_prompt(
+    context_info: Dict[str, Any],
+    categories: List[str],
+    predicted_category: Optional[str],
+) -> str:
+    """Prompt asking the model for the diagram category only."""
+    return f"""Identify the type of this software engineering diagram.
+
+{f"Context suggests this might be a {predicted_category} diagram." if predicted_category and predicted_category != "unknown" else ""}
+{f"Section heading: {context_info['current_heading']}" if context_info['current_heading'] else ""}
+
+Examine the visual elements carefully and choose ONE category from: {', '.join(categories)}
+
+{DISTINGUISHING_FEATURES}
+
+Reply with only the category name, nothing else."""
+
+
+def resolve_description_prompts(
+    categories: List[str],
+    category_prompts: Dict[str, Any],
+) -> Dict[str, str]:
+    """
+    Map every lowercase category (plus "other") to its description prompt,
+    applying the "other" and generic fallbacks once up front.
+    """
+    fallback = category_prompts.get("other", {}).get("prompt", "Describe this diagram in detail.")
+    return {
+        c.lower(): category_prompts.get(c, {}).get("prompt", fallback)
+        for c in [*categories, "other"]
+    }
+
+
+def build_description_prompt(
+    context_info: Dict[str, Any],
+    base_prompt: str,
+) -> str:
+    """Category-specific description prompt, enriched with document context."""
+    desc_prompt = base_prompt
+
+    # Add context to description prompt if available
+    if context_info['text_before'] or context_info['text_after']:
+        desc_prompt += f"\n\nAdditional context from the document:\n"
+        if context_info['text_before']:
+            desc_prompt += f"Before image: {context_info['text_before'][:200]}\n"
+        if context_info['text_after']:
+            desc_prompt += f"After image: {context_info['text_after'][:200]}\n"
+    return desc_prompt
+
+
+def _likely_categories(
+    context_info: Dict[str, Any],
+    categories: List[str],
+    category_prompts: Dict[str, Any],
+    limit: int = COMBINED_TEMPLATE_LIMIT,
+) -> List[str]:
+    """
+    Categories whose configured keywords occur in the image's document
+    context, most keyword hits first (ties keep config order).
+    """
+    text = " ".join(
+        context_info[k] for k in ("current_heading", "alt_text", "text_before", "text_after")
+    ).lower()
+    if not text.strip():
+        return []
+    scored = []
+    for pos, cat in enumerate(categories):
+        keywords = category_prompts.get(cat, {}).get("keywords", [])
+        hits = sum(1 for kw in keywords if kw.lower() in text)
+        if hits:
+            scored.append((-hits, pos, cat))
+    return [cat for _, _, cat in sorted(scored)[:limit]]
+
+
+def build_combined_prompt(
+    context_info: Dict[str, Any],
+    categories: List[str],
+    category_prompts: Dict[str, Any],
+) -> str:
+    """
+    Prompt asking for the category and description in a single JSON reply,
+    so each image needs only one request with the image attached.
+    Embedding every category's description prompt would cost thousands of
+    prompt tokens per image, so only the likeliest categories (by keyword
+    match against the context) get their full checklist; the rest are
+    covered by their focus areas.
+    """
+    focus_lines = []
+    for cat in categories:
+        focus = category_prompts.get(cat, {}).get("focus_areas")
+        if focus:
+            focus_lines.append(f"- {cat}: {', '.join(focus)}")
+
+    checklists = []
+    for cat in _likely_categories(context_info, categories, category_prompts):
+        template = category_prompts.get(cat, {}).get("prompt")
+        if template:
+            checklists.append(f"If it is a {cat}:\n{template}\n")
+    checklist_block = ""
+    if checklists:
+        checklist_block = (
+            "The document context points to these types; if you chose one of "
+            "them, follow its checklist:\n\n" + "\n".join(checklists)
+        )
+
+    context_lines = []
+    if context_info['text_before']:
+        context_lines.append(f"Before image: {context_info['text_before'][:200]}")
+    if context_info['text_after']:
+        context_lines.append(f"After image: {context_info['text_after'][:200]}")
+
+    return f"""Analyze this software engineering diagram.
+
+{f"Section heading: {context_info['current_heading']}" if context_info['current_heading'] else ""}
+{f"Image alt text: {context_info['alt_text']}" if context_info['alt_text'] else ""}
+{"Additional context from the document:" + chr(10) + chr(10).join(context_lines) if context_lines else ""}
+
+1. Examine the visual elements carefully and choose ONE category from: {', '.join(categories)}
+
+{DISTINGUISHING_FEATURES}
+
+2. Write a detailed technical description of the diagram. Cover the elements
+relevant to the chosen category:
+{chr(10).join(focus_lines)}
+{checklist_block}
+Be factual and comprehensive. List exactly what you see.
+
+Respond ONLY with JSON: {{"category": "<one of the categories above>", "description": "<technical description>"}}"""
+
+
+# Salvage fields from replies that are not valid JSON, e.g. cut off by num_predict
+_JSON_FIELD_RES = {
+    name: re.compile(rf'"{name}"\s*:\s*"((?:[^"\\]|\\.)*)')
+    for name in ("category", "description")
+}
+
+
+def _extract_json_field(response: str, name: str) -> Optional[str]:
+    """Pull a string field out of malformed JSON; None if absent."""
+    m = _JSON_FIELD_RES[name].search(response)
+    if not m:
+        return None
+    try:
+        return orjson.loads(f'"{m.group(1)}"')
+    except orjson.JSONDecodeError:
+        return m.group(1)
+
+
+def parse_combined_response(response: str) -> Optional[Tuple[str, str]]:
+    """
+    Extract (category, description) from a combined reply, or None. Falls back to regex extraction when the reply is not valid JSON.
+    """
+    if not response:
+        return None
+    try:
+        data = orjson.loads(response)
+    except orjson.JSONDecodeError:
+        data = {name: _extract_json_field(response, name) for name in _JSON_FIELD_RES}
+    if not isinstance(data, dict):
+        return None
+    category = data.get("category")
+    description = data.get("description")
+    if not isinstance(category, str) or not isinstance(description, str):
+        return None
+    return category.lower().strip(), description.strip()
+
+
+async def analyze_diagram(
+    client: OllamaClient,
+    context_info: Dict[str, Any],
+    categories: List[str],
+    category_prompts: Dict[str, Any],
+    model: str,
+    image_b64: str,
+    image_digest: Optional[str] = None,
+    image_variant: str = "",
+) -> Optional[Tuple[str, str]]:
+    """
+    Categorization and description in one request.
+    Returns (category, description), or None if the reply could not be parsed.
+    """
+    response = await call_ollama(
+        client,
+        model=model,
+        prompt=build_combined_prompt(context_info, categories, category_prompts),
+        temperature=0.1,
+        format="json",
+        image_digest=image_digest,
+        image_b64=image_b64,
+        max_tokens=COMBINED_MAX_TOKENS,
+        image_variant=image_variant,
+    )
+    return parse_combined_response(response)
+
+
 def load_categories_config(json_path: Path) -> Dict[str, Any]:
     """Load categories and their technical description prompts."""
     with json_path.open(encoding="utf-8") as f:
         return json.load(f)
 
 
+# ---------------------------------------------------------------
+# Per-image pipeline
+# ---------------------------------------------------------------
+class LogQueue:
+    """
+    Console output for the image workers. Messages are queued without
+    blocking, and a single drain task prints whatever has accumulated in one
+    console.print() call, so concurrent workers never wait on Rich rendering.
+    """
+
+    def __init__(self, console: Console):
+        self.console = console
+        self.queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+
+    def print(self, message: str) -> None:
+        self.queue.put_nowait(message)
+
+    async def drain(self) -> None:
+        while True:
+            message = await self.queue.get()
+            batch = []
+            while message is not None:
+                batch.append(message)
+                if self.queue.empty():
+                    break
+                message = self.queue.get_nowait()
+            if batch:
+                self.console.print("\n".join(batch))
+            if message is None:
+                return
+
+    async def close(self, drain_task: "asyncio.Task[None]") -> None:
+        """Flush pending messages and stop the drain task."""
+        self.queue.put_nowait(None)
+        await drain_task
+
+
+@functools.lru_cache(maxsize=4096)
+def _norm_path(path: str) -> str:
+    """NFC-normalize a path; pure ASCII paths (the common case) are already normal."""
+    return path if path.isascii() else unicodedata.normalize('NFC', path)
+
+
+def _resolve_image_path(base_dir: Path, ref_path: str) -> Path:
+    """
+    Resolve an image reference relative to the (already resolved) markdown
+    directory. A lexical normpath join is enough to open the file, so this
+    skips the realpath() syscalls of Path.resolve().
+    """
+    # Normalize path for Unicode issues
+    img_path_str_norm = _norm_path(ref_path).strip()
+    return Path(os.path.normpath(os.path.join(base_dir, img_path_str_norm)))
+
+
+NO_DESCRIPTION = "No description generated."
+
+
+def _scan_file_sizes(paths: Set[Path]) -> Dict[Path, int]:
+    """
+    Return {path: size in bytes} for those of ``paths`` that are existing
+    files, using one os.scandir() pass per directory instead of separate
+    is_file()/stat() calls per image.
+    """
+    by_dir: Dict[Path, Set[str]] = {}
+    for path in paths:
+        by_dir.setdefault(path.parent, set()).add(path.name)
+
+    sizes: Dict[Path, int] = {}
+    for directory, names in by_dir.items():
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name in names and entry.is_file():
+                        sizes[directory / entry.name] = entry.stat().st_size
+        except OSError:
+            continue
+
+    # Names that did not match exactly (e.g. different case on a
+    # case-insensitive filesystem) get an individual stat()
+    for path in paths - sizes.keys():
+        try:
+            if path.is_file():
+                sizes[path] = path.stat().st_size
+        except OSError:
+            pass
+    return sizes
+
+
+@dataclass
+class ImageResult:
+    """Outcome of analyzing a single image reference."""
+    category: str = "unknown"
+    description: str = ""
+    predicted_category: Optional[str] = None
+    analyzed: bool = False
+
+
+async def process_image(
+    client: OllamaClient,
+    idx: int,
+    img_info: Dict[str, Any],
+    args: argparse.Namespace,
+    log: "LogQueue",
+    img_path: Path,
+    file_size: Optional[int],
+    categories: List[str],
+    category_prompts: Dict[str, Any],
+    categories_lower: frozenset,
+    description_prompts: Dict[str, str],
+    total: int,
+    image_digest: Optional[str] = None,
+) -> ImageResult:
+    """
+    Predict the category from context, categorize and describe one image.
+    img_path is the resolved image file and file_size its size in bytes, or
+    None if it does not exist; image_digest is the content hash computed
+    during deduplication, if any.
+    """
+    result = ImageResult()
+
+    if args.verbose:
+        log.print(f"\n[cyan]Processing [{idx}/{total}]: {img_path.name}[/cyan]")
+        if img_info['current_heading']:
+            log.print(f"  [dim]Section: {img_info['current_heading']}[/dim]")
+
+    # Check if file exists and is valid
+    if file_size is None:
+        result.description = f"⚠️ Image file not found: `{img_info['path']}`"
+        log.print(f"[red]Missing: {img_path}[/red]")
+        return result
+    if not _quick_valid_image(img_path):
+        result.description = f"⚠️ Invalid image file: `{img_info['path']}`"
+        log.print(f"[red]Invalid image: {img_path}[/red]")
+        return result
+
+    # Step 1: Predict the category from the document text alone. The request
+    # needs no image, so it runs alongside image preparation and analysis,
+    # and stays independent of what the model sees in the image.
+    if args.verbose:
+        log.print(f"  [dim][{idx}] Analyzing context for category hints...[/dim]")
+    predict_task = asyncio.create_task(pre_categorize_with_context(
+        client,
+        img_info,
+        categories,
+        args.precategorize_model or args.model,
+        temperature=0.1,
+        categories_lower=categories_lower,
+    ))
+
+    # Encode once (downscaling oversized images); every request reuses it.
+    # Reading, resizing and base64 run in a worker thread.
+    try:
+        image_b64 = await asyncio.to_thread(
+            _prepare_image_base64, img_path, args.max_side, args.jpeg_quality, file_size
+        )
+    except Exception as e:
+        predict_task.cancel()
+        result.description = f"⚠️ Invalid image file: `{img_info['path']}`"
+        log.print(f"[red]Invalid image: {e}[/red]")
+        return result
+
+    # Cached replies are only valid for the same prepared payload
+    image_variant = _image_variant(args.max_side, args.jpeg_quality)
+
+    # Step 2: Categorize and describe in a single request
+    if args.verbose:
+        log.print(f"  [dim][{idx}] Analyzing diagram (type + description)...[/dim]")
+
+    parsed = await analyze_diagram(
+        client,
+        img_info,
+        categories,
+        category_prompts,
+        args.model,
+        image_b64,
+        image_digest=image_digest,
+        image_variant=image_variant,
+    )
+
+    predicted_category = await predict_task
+    if predicted_category and args.verbose:
+        log.print(f"  [blue][{idx}] Context suggests: {predicted_category}[/blue]")
+
+    if parsed:
+        category, description = parsed
+    else:
+        # Fall back to separate categorize and describe requests, using the
+        # context prediction as a hint
+        if args.verbose:
+            log.print(f"  [yellow][{idx}] Combined reply was not valid JSON, falling back to separate requests[/yellow]")
+
+        category_response = await call_ollama(
+            client,
+            model=args.model,
+            prompt=build_category_prompt(img_info, categories, predicted_category),
+            image_path=img_path,
+            temperature=0.0,
+            image_digest=image_digest,
+            image_b64=image_b64,
+            image_variant=image_variant,
+            max_tokens=CATEGORY_MAX_TOKENS,
+            stop=["\n"],
+            greedy=True,
+        )
+        category = category_response.lower().strip()
+
+    # Normalize category
+    if category not in categories_lower:
+        category = "other"
+
+    if args.verbose:
+        log.print(f"  [green][{idx}] Final type: {category}[/green]")
+        if predicted_category and predicted_category != category:
+            log.print(f"  [yellow][{idx}] Context prediction was different[/yellow]")
+
+    if not parsed:
+        # Step 3 (fallback): Generate technical description
+        if args.verbose:
+            log.print(f"  [dim][{idx}] Generating technical description...[/dim]")
+
+        description = await call_ollama(
+            client,
+            model=args.model,
+            prompt=build_description_prompt(img_info, description_prompts[category]),
+            image_path=img_path,
+            temperature=0.1,
+            image_digest=image_digest,
+            image_b64=image_b64,
+            image_variant=image_variant,
+            max_tokens=DESCRIPTION_MAX_TOKENS,
+        )
+
+    if not description:
+        description = NO_DESCRIPTION
+
+    if args.verbose and len(description) > 80:
+        log.print(f"  [dim][{idx}] {description[:80]}...[/dim]")
+
+    result.category = category
+    result.description = description
+    result.predicted_category = predicted_category
+    result.analyzed = True
+    return result
+
+
+async def process_all(
+    cache: Optional[ResponseCache],
+    image_refs: List[Dict[str, Any]],
+    args: argparse.Namespace,
+    console: Console,
+    base_dir: Path,
+    categories: List[str],
+    category_prompts: Dict[str, Any],
+    categories_lower: frozenset,
+    description_prompts: Dict[str, str],
+    done: Dict[int, ImageResult],
+    on_result: Callable[[int, ImageResult], None],
+) -> None:
+    """
+    Analyze all images concurrently, with at most ``args.concurrency`` images
+    in flight. References to identical image content (the same file, or
+    byte-identical copies) are analyzed once and share the result.
+    Indices already in ``done`` (resumed from a checkpoint) are skipped.
+    ``on_result(index, result)`` is called for every other reference as
+    soon as its result is known, in completion order.
+    """
+    pending_paths = {
+        i: _resolve_image_path(base_dir, img_info['path'])
+        for i, img_info in enumerate(image_refs)
+        if i not in done
+    }
+    file_sizes = _scan_file_sizes(set(pending_paths.values()))
+
+    # Group references by content hash; missing or unreadable files group by path
+    groups: Dict[str, List[int]] = {}
+    digests: Dict[str, Optional[str]] = {}
+    for i, img_path in pending_paths.items():
+        digest = None
+        if img_path in file_sizes:
+            try:
+                digest = file_digest(img_path)
+            except OSError:
+                pass
+        key = digest or str(img_path)
+        groups.setdefault(key, []).append(i)
+        digests[key] = digest
+
+    pending = len(image_refs) - len(done)
+    if len(groups) < pending:
+        console.print(f"[green]{len(groups)} unique image(s) to analyze[/green]")
+
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+    log = LogQueue(console)
+    drain_task = asyncio.create_task(log.drain())
+
+    with Progress(console=console, disable=args.verbose) as progress:
+        task = progress.add_task("Processing diagrams...", total=len(groups))
+
+        async with OllamaClient(cache=cache) as client:
+            async def bounded(indices: List[int], image_digest: Optional[str]) -> None:
+                i = indices[0]
+                async with semaphore:
+                    result = await process_image(
+                        client,
+                        i + 1,
+                        image_refs[i],
+                        args,
+                        log,
+                        pending_paths[i],
+                        file_sizes.get(pending_paths[i]),
+                        categories,
+                        category_prompts,
+                        categories_lower,
+                        description_prompts,
+                        len(image_refs),
+                        image_digest,
+                    )
+                for j in indices:
+                    on_result(j, result)
+                progress.advance(task)
+
+            try:
+                await asyncio.gather(
+                    *(bounded(indices, digests[key]) for key, indices in groups.items())
+                )
+            finally:
+                await log.close(drain_task)
+
+
+# ---------------------------------------------------------------
+# Output and checkpointing
+# ---------------------------------------------------------------
+OUTPUT_BUFFER_SIZE = 1 << 20  # bytes per output file
+
+
+class OutputWriter:
+    """
+    Write the annotated markdown and the summary incrementally. Results may
+    arrive in any order; each is held back only until every earlier image
+    has been written, so the outputs always grow in document order.
+
+    Summary entries go to a ``.part`` file first, because the statistics
+    block that heads the summary is only known once every image is done.
+    """
+
+    def __init__(
+        self,
+        md_text: str,
+        image_refs: List[Dict[str, Any]],
+        output_md_path: Path,
+        summary_md_path: Path,
+        source_name: str,
+    ):
+        self.md_text = md_text
+        self.image_refs = image_refs
+        self.summary_md_path = summary_md_path
+        self.summary_part_path = summary_md_path.with_name(summary_md_path.name + ".part")
+        self.summary_header = (
+            "# Diagram Analysis Summary\n"
+            f"**Source Document:** {source_name}\n"
+            f"**Total Diagrams:** {len(image_refs)}\n"
+            "\n---\n\n"
+        )
+        self.category_counts: Dict[str, int] = {}
+        self.context_predictions = {"correct": 0, "total": 0}
+        self._pending: Dict[int, ImageResult] = {}
+        self._next = 0
+        self._last_idx = 0
+
+        output_md_path.parent.mkdir(parents=True, exist_ok=True)
+        summary_md_path.parent.mkdir(parents=True, exist_ok=True)
+        # Large buffers, flushed once per add() rather than per line
+        self._out_md = output_md_path.open("w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE)
+        self._out_summary = self.summary_part_path.open(
+            "w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE
+        )
+
+    def add(self, i: int, result: ImageResult) -> None:
+        """Record the result for image_refs[i] and flush everything now in order."""
+        self._pending[i] = result
+        if self._next not in self._pending:
+            return
+        while self._next in self._pending:
+            self._write(self._next, self._pending.pop(self._next))
+            self._next += 1
+        self._out_md.flush()
+        self._out_summary.flush()
+
+    def _write(self, i: int, result: ImageResult) -> None:
+        img_info = self.image_refs[i]
+        idx = i + 1
+        category = result.category
+        predicted_category = result.predicted_category
+        description = result.description
+
+        if result.analyzed:
+            # Track context prediction accuracy
+            if predicted_category:
+                self.context_predictions["total"] += 1
+                if predicted_category == category:
+                    self.context_predictions["correct"] += 1
+
+            # Count categories
+            self.category_counts[category] = self.category_counts.get(category, 0) + 1
+
+        # Preserve markdown up to image
+        out_md = self._out_md
+        out_md.write(self.md_text[self._last_idx:img_info['start']])
+        out_md.write(img_info['full_match'])
+
+        # Add technical description to markdown
+        out_md.write(
+            f"\n\n**Diagram Type:** {category.replace('_', ' ').title()}\n\n"
+            f"**Technical Description:**\n{description}\n\n"
+        )
+
+        # Add to summary with context info
+        summary = self._out_summary
+        summary.write(f"## Diagram {idx}: {os.path.basename(img_info['path'])}\n\n")
+        summary.write(f"![{img_info['alt_text'] or os.path.basename(img_info['path'])}]({img_info['path']})\n\n")
+        summary.write(f"- **Type:** {category.replace('_', ' ').title()}\n")
+        if predicted_category and predicted_category != category:
+            summary.write(f"- **Context Prediction:** {predicted_category.replace('_', ' ').title()} (mismatch)\n")
+        summary.write(f"- **File:** `{img_info['path']}`\n")
+        if img_info['current_heading']:
+            summary.write(f"- **Section:** {img_info['current_heading']}\n")
+        summary.write(f"- **Description:**\n\n{description}\n\n")
+        summary.write("---\n\n")
+
+        self._last_idx = img_info['end']
+
+    def close(self) -> None:
+        """Write the trailing markdown and assemble the final summary file."""
+        # Add remaining content
+        self._out_md.write(self.md_text[self._last_idx:])
+        self._out_md.close()
+        self._out_summary.close()
+
+        # Statistics go between the summary header and the per-diagram entries
+        stats = io.StringIO()
+        stats.write("## Analysis Statistics\n\n")
+        
+        # Category distribution
+        if self.category_counts:
+            stats.write("### Category Distribution\n\n")
+            for cat, count in sorted(self.category_counts.items()):
+                percentage = (count / len(self.image_refs)) * 100
+                stats.write(f"- **{cat.replace('_', ' ').title()}:** {count} ({percentage:.1f}%)\n")
+        
+        # Context prediction accuracy
+        correct, total = self.context_predictions["correct"], self.context_predictions["total"]
+        if total > 0:
+            accuracy = (correct / total) * 100
+            stats.write(f"\n### Context Prediction Accuracy\n\n")
+            stats.write(f"- **Correct predictions:** {correct}/{total} ({accuracy:.1f}%)\n")
+        
+        stats.write("\n---\n\n")
+
+        with self.summary_md_path.open("w", encoding="utf-8") as out_summary, \
+                self.summary_part_path.open(encoding="utf-8") as body:
+            out_summary.write(self.summary_header)
+            out_summary.write(stats.getvalue())
+            shutil.copyfileobj(body, out_summary)
+        self.summary_part_path.unlink()
+
+
+def load_checkpoint(ckpt_path: Path, image_refs: List[Dict[str, Any]]) -> Dict[int, ImageResult]:
+    """
+    Read results saved by an interrupted run, keyed by image_refs index.
+    Entries whose image path no longer matches the document are ignored, as
+    is a truncated final line.
+    """
+    done: Dict[int, ImageResult] = {}
+    if not ckpt_path.is_file():
+        return done
+    with ckpt_path.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            i = entry.get("idx", 0) - 1
+            if 0 <= i < len(image_refs) and image_refs[i]['path'] == entry.get("path"):
+                predicted_category = entry.get("predicted_category")
+                if entry.get("prediction_saw_image"):
+                    # Written by a version whose hint came from the image request;
+                    # it is not a context-only prediction
+                    predicted_category = None
+                done[i] = ImageResult(
+                    category=entry["category"],
+                    description=entry["description"],
+                    predicted_category=predicted_category,
+                    analyzed=entry.get("analyzed", True),
+                )
+    return done
+
+
+def checkpoint_line(i: int, img_info: Dict[str, Any], result: ImageResult) -> str:
+    """Serialize one finished image as a checkpoint JSON line."""
+    return json.dumps({
+        "idx": i + 1,
+        "path": img_info['path'],
+        "category": result.category,
+        "description": result.description,
+        "predicted_category": result.predicted_category,
+        "analyzed": result.analyzed,
+    }, ensure_ascii=False) + "\n"
+
+
 # ---------------------------------------------------------------
 # Main workflow
 # ---------------------------------------------------------------
+def _env_int(name: str) -> Optional[int]:
+    """Integer value of an environment variable, or None if unset or invalid."""
+    try:
+        return int(os.environ[name])
+    except (KeyError, ValueError):
+        return None
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         description="Generate technical descriptions of diagrams in markdown files."
@@ -223,12 +1100,63 @@ def main() -> None:
         default="qwen3-vl:30b",
         help="Ollama vision model (default: qwen3-vl:30b)",
     )
+    parser.add_argument(
+        "--precategorize-model",
+        default=None,
+        help="Text model for context-only pre-categorization, e.g. qwen2.5:3b-instruct-q4_K_M "
+             "(default: same as --model)",
+    )
     parser.add_argument(
         "--context-size",
         type=int,
         default=500,
         help="Characters of context to analyze around images (default: 500)",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of images analyzed in parallel (default: 4)",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=_env_int("OLLAMA_NUM_PARALLEL"),
+        help="Requests the Ollama server runs in parallel (its OLLAMA_NUM_PARALLEL); "
+             "--concurrency is capped to it (default: $OLLAMA_NUM_PARALLEL if set)",
+    )
+    parser.add_argument(
+        "--max-side",
+        type=int,
+        default=MAX_IMAGE_SIDE,
+        help=f"Downscale images whose longest side exceeds this many pixels (default: {MAX_IMAGE_SIDE})",
+    )
+    parser.add_argument(
+        "--jpeg-quality",
+        type=int,
+        default=JPEG_QUALITY,
+        help=f"JPEG quality used when re-encoding downscaled photos (default: {JPEG_QUALITY})",
+    )
+    parser.add_argument(
+        "--cache-db",
+        default=str(DEFAULT_CACHE_DB),
+        help=f"SQLite file caching Ollama responses across runs (default: {DEFAULT_CACHE_DB})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query Ollama, ignoring and not updating the response cache",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Always query Ollama and overwrite the cached responses",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Reuse results checkpointed by an interrupted run (<output>.ckpt)",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -271,200 +1199,86 @@ def main() -> None:
         console.print("[red]Error: No categories in configuration file.[/red]")
         sys.exit(1)
 
-    # Process each image
-    new_md_parts = []
-    summary_lines = [
-        "# Diagram Analysis Summary\n",
-        f"**Source Document:** {input_md_path.name}\n",
-        f"**Total Diagrams:** {len(image_refs)}\n",
-        "\n---\n\n"
-    ]
-    
-    last_idx = 0
-    category_counts = {}
-    context_predictions = {"correct": 0, "total": 0}
-
-    # Progress tracking
-    iterator = track(image_refs, description="Processing diagrams...") if not args.verbose else image_refs
-
-    for idx, img_info in enumerate(iterator, 1):
-        # Preserve markdown up to image
-        new_md_parts.append(md_text[last_idx:img_info['start']])
-        new_md_parts.append(img_info['full_match'])
-
-        # Normalize path for Unicode issues
-        img_path_str_norm = unicodedata.normalize('NFC', img_info['path']).strip()
-        img_path = (input_md_path.parent / img_path_str_norm).resolve()
-        
-        if args.verbose:
-            console.print(f"\n[cyan]Processing [{idx}/{len(image_refs)}]: {img_path.name}[/cyan]")
-            if img_info['current_heading']:
-                console.print(f"  [dim]Section: {img_info['current_heading']}[/dim]")
-        
-        # Default values
-        category = "unknown"
-        predicted_category = None
-        description = ""
-        
-        # Check if file exists and is valid
-        if not img_path.is_file():
-            description = f"⚠️ Image file not found: `{img_info['path']}`"
-            console.print(f"[red]Missing: {img_path}[/red]")
-        else:
-            try:
-                Image.open(img_path).verify()
-            except Exception as e:
-                description = f"⚠️ Invalid image file: `{img_info['path']}`"
-                console.print(f"[red]Invalid image: {e}[/red]")
-            else:
-                # Check size limit
-                if img_path.stat().st_size > MAX_IMAGE_SIZE:
-                    description = f"⚠️ Image too large (>{MAX_IMAGE_SIZE//1024//1024} MB)"
-                    console.print(f"[yellow]Skipping large file[/yellow]")
-                else:
-                    # Step 1: Pre-categorize using context
-                    if args.verbose:
-                        console.print("  [dim]Analyzing context for category hints...[/dim]")
-                    
-                    predicted_category = pre_categorize_with_context(
-                        img_info,
-                        categories,
-                        args.model,
-                        temperature=0.1
-                    )
-                    
-                    if predicted_category and args.verbose:
-                        console.print(f"  [blue]Context suggests: {predicted_category}[/blue]")
-                    
-                    # Step 2: Categorize the diagram with context hint
-                    cat_prompt = f"""Identify the type of this software engineering diagram.
-
-{f"Context suggests this might be a {predicted_category} diagram." if predicted_category and predicted_category != "unknown" else ""}
-{f"Section heading: {img_info['current_heading']}" if img_info['current_heading'] else ""}
-
-Examine the visual elements carefully and choose ONE category from: {', '.join(categories)}
-
-Key distinguishing features:
-- C4 Model: Has explicit C4 level labels (Context/Container/Component), technology tags in brackets
-- Use Case: Has actors (stick figures), ovals for use cases, system boundary rectangle
-- Class Diagram: Shows classes with attributes/methods, inheritance arrows
-- Entity Relationship: Shows entities with attributes, relationship lines with cardinality
-- Architecture: Shows system components, layers, external services
-- Sequence: Has lifelines, messages between objects, activation boxes
-- Data Flow: Has numbered processes, data stores, external entities
+    # Requests beyond the server's parallelism only queue inside Ollama
+    if args.parallel is None:
+        if args.concurrency > 1:
+            console.print(
+                f"[dim]Tip: start Ollama with OLLAMA_NUM_PARALLEL={args.concurrency} "
+                f"(e.g. `OLLAMA_NUM_PARALLEL={args.concurrency} ollama serve`) so "
+                f"{args.concurrency} images are analyzed at once, and pass --parallel "
+                f"to confirm it[/dim]"
+            )
+    elif args.parallel < args.concurrency:
+        console.print(
+            f"[yellow]Ollama runs {args.parallel} request(s) in parallel; limiting "
+            f"--concurrency from {args.concurrency} to {args.parallel}. Set "
+            f"OLLAMA_NUM_PARALLEL={args.concurrency} on the server to use more.[/yellow]"
+        )
+        args.concurrency = max(1, args.parallel)
 
-Reply with only the category name, nothing else."""
-                    
-                    if args.verbose:
-                        console.print("  [dim]Detecting diagram type from image...[/dim]")
-                    
-                    category_response = call_ollama(
-                        model=args.model,
-                        prompt=cat_prompt,
-                        image_path=img_path,
-                        temperature=0.0,
-                    )
-                    
-                    # Normalize category
-                    category = category_response.lower().strip()
-                    if category not in [c.lower() for c in categories]:
-                        category = "other"
-                    
-                    # Track context prediction accuracy
-                    if predicted_category:
-                        context_predictions["total"] += 1
-                        if predicted_category == category:
-                            context_predictions["correct"] += 1
-                    
-                    # Count categories
-                    category_counts[category] = category_counts.get(category, 0) + 1
-                    
-                    if args.verbose:
-                        console.print(f"  [green]Final type: {category}[/green]")
-                        if predicted_category and predicted_category != category:
-                            console.print(f"  [yellow]Context prediction was different[/yellow]")
-
-                    # Step 3: Generate technical description
-                    desc_prompt = category_prompts.get(
-                        category,
-                        category_prompts.get("other", {})
-                    ).get("prompt", "Describe this diagram in detail.")
-                    
-                    # Add context to description prompt if available
-                    if img_info['text_before'] or img_info['text_after']:
-                        desc_prompt += f"\n\nAdditional context from the document:\n"
-                        if img_info['text_before']:
-                            desc_prompt += f"Before image: {img_info['text_before'][:200]}\n"
-                        if img_info['text_after']:
-                            desc_prompt += f"After image: {img_info['text_after'][:200]}\n"
-                    
-                    if args.verbose:
-                        console.print("  [dim]Generating technical description...[/dim]")
-                    
-                    description = call_ollama(
-                        model=args.model,
-                        prompt=desc_prompt,
-                        image_path=img_path,
-                        temperature=0.1,
-                    )
-                    
-                    if not description:
-                        description = "No description generated."
-                    
-                    if args.verbose and len(description) > 80:
-                        console.print(f"  [dim]{description[:80]}...[/dim]")
+    # Resolve category lookups once instead of per image
+    categories_lower = frozenset(c.lower() for c in categories)
+    description_prompts = resolve_description_prompts(categories, category_prompts)
 
-        # Add technical description to markdown
-        desc_block = (
-            f"\n\n**Diagram Type:** {category.replace('_', ' ').title()}\n\n"
-            f"**Technical Description:**\n{description}\n\n"
+    # Results from an interrupted run are kept in a checkpoint next to the output
+    ckpt_path = output_md_path.with_name(output_md_path.name + ".ckpt")
+    if ckpt_path.exists() and not args.resume:
+        console.print(
+            f"[red]Error: {ckpt_path} holds results from an interrupted run. "
+            f"Re-run with --resume to reuse them, or delete it to start over.[/red]"
         )
-        new_md_parts.append(desc_block)
+        sys.exit(1)
+    done = load_checkpoint(ckpt_path, image_refs) if args.resume else {}
+    if done:
+        console.print(f"[green]Resuming: {len(done)} diagram(s) restored from {ckpt_path.name}[/green]")
 
-        # Add to summary with context info
-        summary_lines.append(f"## Diagram {idx}: {os.path.basename(img_info['path'])}\n\n")
-        summary_lines.append(f"![{img_info['alt_text'] or os.path.basename(img_info['path'])}]({img_info['path']})\n\n")
-        summary_lines.append(f"- **Type:** {category.replace('_', ' ').title()}\n")
-        if predicted_category and predicted_category != category:
-            summary_lines.append(f"- **Context Prediction:** {predicted_category.replace('_', ' ').title()} (mismatch)\n")
-        summary_lines.append(f"- **File:** `{img_info['path']}`\n")
-        if img_info['current_heading']:
-            summary_lines.append(f"- **Section:** {img_info['current_heading']}\n")
-        summary_lines.append(f"- **Description:**\n\n{description}\n\n")
-        summary_lines.append("---\n\n")
+    writer = OutputWriter(md_text, image_refs, output_md_path, summary_md_path, input_md_path.name)
+    for i, result in done.items():
+        writer.add(i, result)
 
-        last_idx = img_info['end']
+    # Process all images concurrently; outputs are written as results arrive
+    cache = None if args.no_cache else ResponseCache(
+        Path(args.cache_db).expanduser(), refresh=args.refresh_cache
+    )
+    # Rewrite the restored results into a fresh checkpoint, so a line cut short
+    # by a crash cannot merge with the next entry; the old file is replaced
+    # only once the new one is complete, so an interrupt here loses nothing
+    tmp_path = ckpt_path.with_name(ckpt_path.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as tmp:
+        for i, result in done.items():
+            tmp.write(checkpoint_line(i, image_refs[i], result))
+    os.replace(tmp_path, ckpt_path)
 
-    # Add remaining content
-    new_md_parts.append(md_text[last_idx:])
+    try:
+        with ckpt_path.open("a", encoding="utf-8", buffering=1) as ckpt:
+            def on_result(i: int, result: ImageResult) -> None:
+                # Failed generations are left out so a resumed run retries them
+                if result.description != NO_DESCRIPTION:
+                    ckpt.write(checkpoint_line(i, image_refs[i], result))
+                writer.add(i, result)
 
-    # Add statistics to summary
-    stats_lines = ["## Analysis Statistics\n\n"]
-    
-    # Category distribution
-    if category_counts:
-        stats_lines.append("### Category Distribution\n\n")
-        for cat, count in sorted(category_counts.items()):
-            percentage = (count / len(image_refs)) * 100
-            stats_lines.append(f"- **{cat.replace('_', ' ').title()}:** {count} ({percentage:.1f}%)\n")
-    
-    # Context prediction accuracy
-    if context_predictions["total"] > 0:
-        accuracy = (context_predictions["correct"] / context_predictions["total"]) * 100
-        stats_lines.append(f"\n### Context Prediction Accuracy\n\n")
-        stats_lines.append(f"- **Correct predictions:** {context_predictions['correct']}/{context_predictions['total']} ({accuracy:.1f}%)\n")
-    
-    stats_lines.append("\n---\n\n")
-    
-    # Insert after the header
-    summary_lines[4:4] = stats_lines
+            asyncio.run(process_all(
+                cache,
+                image_refs,
+                args,
+                console,
+                input_md_path.parent,
+                categories,
+                category_prompts,
+                categories_lower,
+                description_prompts,
+                done,
+                on_result,
+            ))
+    finally:
+        if cache is not None:
+            cache.close()
 
-    # Write output files
-    output_md_path.parent.mkdir(parents=True, exist_ok=True)
-    output_md_path.write_text("".join(new_md_parts), encoding="utf-8")
-    
-    summary_md_path.parent.mkdir(parents=True, exist_ok=True)
-    summary_md_path.write_text("".join(summary_lines), encoding="utf-8")
+    writer.close()
+    ckpt_path.unlink()
+
+    category_counts = writer.category_counts
+    context_predictions = writer.context_predictions
 
     # Final report
     console.print(f"\n[green bold]✅ Processing Complete[/green bold]")
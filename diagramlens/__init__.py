@@ -0,0 +1,19 @@
+"""Shared helpers for the DiagramLens scripts."""
+
+from .ollama_client import (
+    OLLAMA_URL,
+    OllamaClient,
+    ResponseCache,
+    chat_sync,
+    file_digest,
+    load_image_as_base64,
+)
+
+__all__ = [
+    "OLLAMA_URL",
+    "OllamaClient",
+    "ResponseCache",
+    "chat_sync",
+    "file_digest",
+    "load_image_as_base64",
+]
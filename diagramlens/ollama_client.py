@@ -0,0 +1,269 @@
+"""
+ollama_client.py - Shared client for the local Ollama /api/chat endpoint
+
+Used by annotate_images_enhanced.py and test_ollama.py, so connection
+pooling, retries, streaming, orjson encoding and the response cache behave
+the same everywhere.
+"""
+
+import asyncio
+import base64
+import hashlib
+import mmap
+import os
+import random
+import sqlite3
+import sys
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import httpx
+import orjson
+
+OLLAMA_URL = "http://localhost:11434/api/chat"
+REQUEST_TIMEOUT = 180  # seconds
+MAX_RETRIES = 3  # attempts per request on transient errors
+RETRY_BASE_DELAY = 1.0  # seconds; doubled after every failed attempt
+# One pooled client is shared by every request, so connections to Ollama stay alive
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def load_image_as_base64(image_path: Path) -> str:
+    """
+    Read an image file and return a base64‑encoded string.
+    The file is memory-mapped and encoded in one C-level pass, so the raw
+    bytes are never copied into a Python buffer.
+    """
+    with image_path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return base64.b64encode(mm).decode("ascii")
+
+
+def file_digest(path: Path) -> str:
+    """BLAKE2b digest of a file's contents, used to key cached responses."""
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent SQLite store of Ollama responses, keyed by image content,
+    prompt, model and generation options. Re-running on the same document
+    only calls Ollama for images (or prompts) it has not seen before.
+    With refresh=True lookups always miss, so every response is fetched
+    again and overwrites its cached entry.
+    """
+
+    def __init__(self, db_path: Path, refresh: bool = False):
+        self._refresh = refresh
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(image_digest: str, prompt: str, model: str, options: Dict[str, Any]) -> str:
+        return hashlib.blake2b(
+            image_digest.encode() + b"|" + prompt.encode() + b"|" + model.encode()
+            + b"|" + orjson.dumps(options, option=orjson.OPT_SORT_KEYS),
+            digest_size=16,
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if self._refresh:
+            return None
+        row = self._conn.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, response: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)",
+            (key, response),
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def _error_detail(resp: httpx.Response) -> str:
+    """Ollama's "error" field from a failed response, or its raw body."""
+    try:
+        data = orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        return resp.text.strip()
+    if isinstance(data, dict) and "error" in data:
+        return str(data["error"])
+    return resp.text.strip()
+
+
+class OllamaClient:
+    """
+    Async client for Ollama's chat API over one pooled httpx connection
+    pool. Use it as an async context manager; every chat() call made through
+    it shares connections and, if given, the response cache.
+    """
+
+    def __init__(
+        self,
+        url: str = OLLAMA_URL,
+        timeout: float = REQUEST_TIMEOUT,
+        cache: Optional[ResponseCache] = None,
+        limits: httpx.Limits = HTTP_LIMITS,
+    ):
+        self.url = url
+        self.cache = cache
+        self._http = httpx.AsyncClient(timeout=timeout, limits=limits)
+
+    async def __aenter__(self) -> "OllamaClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    async def chat(
+        self,
+        model: str,
+        prompt: str,
+        image_path: Optional[Path] = None,
+        temperature: float = 0.0,
+        format: Optional[str] = None,
+        image_digest: Optional[str] = None,
+        image_b64: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        greedy: bool = False,
+        image_variant: str = "",
+    ) -> str:
+        """
+        Send one chat request with an optional image and return the reply
+        text, or "" if the request failed (the error goes to stderr).
+        Pass format="json" to have Ollama constrain the reply to valid JSON.
+        max_tokens caps the number of generated tokens and stop ends generation
+        at any of the given sequences, so short answers don't decode at length.
+        greedy=True always picks the most likely token (top_k=1, no repeat
+        penalty), which suits one-word answers such as a category name.
+        Previously seen (image, prompt, model, options) requests are answered
+        from the cache; image_digest avoids re-hashing an already hashed image.
+        image_b64 attaches an already prepared image instead of reading image_path.
+        image_variant identifies how that image was prepared (e.g. resize
+        settings) and is part of the cache key, since image_digest only covers
+        the original file.
+        """
+        options: Dict[str, Any] = {"temperature": temperature}
+        if max_tokens is not None:
+            options["num_predict"] = max_tokens
+        if stop:
+            options["stop"] = stop
+        if greedy:
+            options.update(top_k=1, top_p=1.0, repeat_penalty=1.0)
+
+        cache_key = None
+        if self.cache is not None:
+            if image_path and not image_digest:
+                image_digest = file_digest(image_path)
+            key_options = {**options, "format": format}
+            if image_variant:
+                key_options["image_variant"] = image_variant
+            cache_key = ResponseCache.make_key(image_digest or "", prompt, model, key_options)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        # Build message with image attached if provided
+        message = {"role": "user", "content": prompt}
+        if image_b64 is None and image_path:
+            # Callers validate the image beforehand
+            image_b64 = load_image_as_base64(image_path)
+        if image_b64 is not None:
+            message["images"] = [image_b64]
+
+        payload = {
+            "model": model,
+            "messages": [message],
+            "options": options,
+            # Streamed replies arrive token by token, so the read timeout bounds
+            # the gap between tokens rather than the whole generation
+            "stream": True,
+        }
+        if format:
+            payload["format"] = format
+
+        # The base64 image dominates the body; orjson encodes it far faster than json
+        body = orjson.dumps(payload)
+
+        # Transient failures (connection errors, timeouts, 5xx) are retried with
+        # exponential backoff; anything else, including 4xx, fails immediately.
+        for attempt in range(MAX_RETRIES):
+            try:
+                parts = []
+                async with self._http.stream(
+                    "POST", self.url, content=body, headers=JSON_HEADERS
+                ) as resp:
+                    if resp.is_error:
+                        # Read the body while the stream is open; it holds Ollama's reason
+                        await resp.aread()
+                    resp.raise_for_status()
+                    async for line in resp.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = orjson.loads(line)
+                        if "error" in chunk:
+                            raise RuntimeError(chunk["error"])
+                        # Read through to the end (no break on "done") so the
+                        # body is fully consumed and the connection is pooled
+                        parts.append(chunk.get("message", {}).get("content", ""))
+                content = "".join(parts).strip()
+                break
+            except (httpx.TransportError, httpx.HTTPStatusError) as exc:
+                retryable = (
+                    not isinstance(exc, httpx.HTTPStatusError)
+                    or exc.response.status_code >= 500
+                )
+                if not retryable or attempt == MAX_RETRIES - 1:
+                    error_text = f"[ERROR] Ollama request failed: {exc}\n"
+                    if isinstance(exc, httpx.HTTPStatusError):
+                        detail = _error_detail(exc.response)
+                        if detail:
+                            error_text += f"Details: {detail}\n"
+                    sys.stderr.write(error_text)
+                    return ""
+                await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 0.5))
+            except Exception as exc:
+                sys.stderr.write(f"[ERROR] Ollama request failed: {exc}\n")
+                return ""
+
+        if cache_key is not None and content:
+            self.cache.put(cache_key, content)
+        return content
+
+
+def chat_sync(
+    model: str,
+    prompt: str,
+    image_path: Optional[Path] = None,
+    url: str = OLLAMA_URL,
+    timeout: float = REQUEST_TIMEOUT,
+    **kwargs: Any,
+) -> str:
+    """
+    One-off blocking chat request, for scripts that are not async.
+    Responses are never cached: the cache belongs to an OllamaClient, and
+    this creates a throwaway client without one. Use an OllamaClient with a
+    ResponseCache for cached requests.
+    """
+    async def run() -> str:
+        async with OllamaClient(url=url, timeout=timeout) as client:
+            return await client.chat(model, prompt, image_path=image_path, **kwargs)
+
+    return asyncio.run(run())
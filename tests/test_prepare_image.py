@@ -0,0 +1,53 @@
+"""Tests for the image preprocessing in annotate_images_enhanced.py."""
+
+import base64
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import annotate_images_enhanced as annotate  # noqa: E402
+
+
+def _noise_image(path: Path, side: int, fmt: str, **save_args) -> None:
+    """Save random RGB noise, which neither PNG nor JPEG can compress well."""
+    Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(path, fmt, **save_args)
+
+
+class PrepareImageTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def _prepared_size(self, path: Path, **kwargs) -> int:
+        return len(base64.b64decode(annotate._prepare_image_base64(path, **kwargs)))
+
+    def test_noisy_png_within_max_side_fits(self):
+        # Lossless PNG of noise stays oversized, so it must fall back to JPEG
+        path = self.dir / "noise.png"
+        _noise_image(path, 1536, "PNG")
+        self.assertGreater(path.stat().st_size, annotate.MAX_IMAGE_SIZE)
+        self.assertLessEqual(self._prepared_size(path), annotate.MAX_IMAGE_SIZE)
+
+    def test_noisy_jpeg_at_full_quality_fits(self):
+        # A single re-encode at this quality is still over the limit
+        path = self.dir / "noise.jpg"
+        _noise_image(path, 1800, "JPEG", quality=100)
+        self.assertGreater(path.stat().st_size, annotate.MAX_IMAGE_SIZE)
+        size = self._prepared_size(path, max_side=2048, jpeg_quality=100)
+        self.assertLessEqual(size, annotate.MAX_IMAGE_SIZE)
+
+    def test_small_image_is_sent_unchanged(self):
+        path = self.dir / "small.png"
+        Image.new("RGB", (64, 64), "white").save(path, "PNG")
+        self.assertEqual(self._prepared_size(path), path.stat().st_size)
+
+
+if __name__ == "__main__":
+    unittest.main()